@@ -4,23 +4,94 @@
 #
 
 import argparse
+import concurrent.futures
+import contextlib
+from datetime import datetime, timedelta
+import functools
 import logging
-import math
 import os.path
 import shlex
 import signal
+import struct
 import subprocess
 import sys
 import tempfile
-from time import sleep
 
-from matplotlib.colors import LogNorm
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import LogNorm, Normalize
 import matplotlib.pyplot as plt
 import numpy as np
 
 from hdpipe.general_helpers import signal_handler, setup_logging
 from hdpipe.version import __version__
 
+# heimdall candidate file columns
+# s/n, time and dm stay double precision, the rest fits into narrower types
+_BASE_DTYPE = np.dtype(
+    [
+        ("snr", np.float64),
+        ("samp_nr", np.int64),
+        ("time", np.float64),
+        ("filter", np.int8),
+        ("dmtrial", np.int32),
+        ("dm", np.float64),
+        ("n_clusters", np.int32),
+        ("start", np.int64),
+        ("end", np.int64),
+    ]
+)
+
+# additional fields that we fill in
+_EXTRA_DTYPE = np.dtype(
+    [("cand_file_nr", int), ("fil_file_nr", int), ("total_time", float)]
+)
+
+_NEW_DTYPE = np.dtype(list(_BASE_DTYPE.descr) + list(_EXTRA_DTYPE.descr))
+
+# psrsh zap files for each zap mode
+_ZAP_FILES = {
+    # no zapping
+    "None": "none.psh",
+    # Lovell 20cm data
+    # this works for 672 and 800 channel data
+    "Lovell_20cm": "Lovell_20cm.psh",
+    # Lovell 80cm data
+    # currently untested
+    "Lovell_80cm": "Lovell_80cm.psh",
+    # MeerKAT L-band 1024 channel data
+    "MeerKAT_20cm": "MeerKAT_20cm.psh",
+}
+
+# value types of the sigproc filterbank header keywords
+# i: int, d: double, b: signed char, s: length-prefixed string
+_SIGPROC_KEYS = {
+    "telescope_id": "i",
+    "machine_id": "i",
+    "data_type": "i",
+    "barycentric": "i",
+    "pulsarcentric": "i",
+    "nbits": "i",
+    "nsamples": "i",
+    "nchans": "i",
+    "nifs": "i",
+    "nbeams": "i",
+    "ibeam": "i",
+    "az_start": "d",
+    "za_start": "d",
+    "src_raj": "d",
+    "src_dej": "d",
+    "tstart": "d",
+    "tsamp": "d",
+    "fch1": "d",
+    "foff": "d",
+    "fchannel": "d",
+    "refdm": "d",
+    "period": "d",
+    "signed": "b",
+    "rawdatafile": "s",
+    "source_name": "s",
+}
+
 
 def parse_args():
     """
@@ -50,6 +121,14 @@ def parse_args():
         help="Output plots to file rather than to screen.",
     )
 
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        dest="cache",
+        default=False,
+        help="Cache the parsed candidates in .npy files next to the candidate files.",
+    )
+
     parser.add_argument(
         "-z",
         "--zap_mode",
@@ -76,177 +155,227 @@ def parse_args():
     return args
 
 
-def dtype_add_fields(data, dtype):
-    """
-    Add fields to dtype.
-    data is that array where the fields should be added.
-    dtype is a dtype definition of the new fields.
-    Return is a numpy dtype object.
-    """
-
-    dtype = np.dtype(dtype)
-
-    # check that field names are not already there
-    for field in dtype.names:
-        if field in data.dtype.names:
-            raise RuntimeError("Field is already there: {0}".format(field))
-
-    r = list(data.dtype.descr) + list(dtype.descr)
-
-    r = np.dtype(r)
-
-    return r
-
-
-def load_data(filename):
+def load_data(filename, use_cache=False):
     """
     Load and parse heimdall candidate output.
-    """
 
-    dtype = [
-        ("snr", float),
-        ("samp_nr", int),
-        ("time", float),
-        ("filter", int),
-        ("dmtrial", int),
-        ("dm", float),
-        ("n_clusters", int),
-        ("start", int),
-        ("end", int),
-    ]
+    The file number fields are left for the caller to fill in.
 
-    temp = np.genfromtxt(filename, dtype=dtype)
-    temp = np.atleast_1d(temp)
-
-    dtype = [("cand_file", "|U4096"), ("fil_file", "|U4096"), ("total_time", float)]
-    new_dtype = dtype_add_fields(temp, dtype)
-
-    data = np.zeros(len(temp), dtype=new_dtype)
+    Parameters
+    ----------
+    filename: str
+        The name of the candidate file.
+    use_cache: bool
+        Whether to cache the parsed candidates in a numpy binary file next
+        to the candidate file and to load them from there if it is up to
+        date.
+    """
 
-    # fill in
-    for field in data.dtype.names:
-        if field in temp.dtype.names:
-            data[field] = temp[field]
+    log = logging.getLogger("hdpipe.candviewer")
 
-    data["cand_file"] = filename
+    cache_file = "{0}.npy".format(filename)
+    temp = None
+
+    if os.path.getsize(filename) == 0:
+        # heimdall writes empty files if there are no candidates
+        temp = np.empty(0, dtype=_BASE_DTYPE)
+    elif (
+        use_cache
+        and os.path.isfile(cache_file)
+        and os.path.getmtime(cache_file) >= os.path.getmtime(filename)
+    ):
+        temp = np.load(cache_file)
+
+        # the cache might have been written with a different column layout
+        if temp.dtype != _BASE_DTYPE:
+            log.info("Cache file has outdated layout, ignoring it: %s", cache_file)
+            temp = None
+
+    if temp is None:
+        temp = np.loadtxt(filename, dtype=_BASE_DTYPE)
+        temp = np.atleast_1d(temp)
+
+        if use_cache:
+            try:
+                np.save(cache_file, temp)
+            except OSError as e:
+                log.warning("Could not write cache file: %s", e)
+
+    data = np.empty(len(temp), dtype=_NEW_DTYPE)
+
+    # copy all heimdall fields at once using a multi-field view
+    data[list(_BASE_DTYPE.names)] = temp
+    data["cand_file_nr"] = 0
+    data["fil_file_nr"] = 0
+    data["total_time"] = 0.0
 
     return data
 
 
-def remove_bad_cands(t_data):
+def remove_bad_cands(data):
     """
     Remove candidates that are RFI.
-    """
 
-    data = np.copy(t_data)
+    The input is not modified, the boolean indexing returns a new array.
+    """
 
     # remove all low-snr candidates and the ones that are really wide
-    mask = (
-        (data["snr"] > 7.0)
-        & (data["filter"] <= 10)
-        & (data["dm"] > 320)
-        & (data["dm"] < 350)
-        & (data["n_clusters"] > 5)
-    )
-    data = data[mask]
-
-    return data
-
-
-def plot_candidates(t_data, filename, output_plots):
+    # combine the criteria in place to avoid temporary boolean arrays
+    mask = np.greater(data["snr"], 7.0)
+    mask &= np.less_equal(data["filter"], 10)
+    mask &= np.greater(data["dm"], 320)
+    mask &= np.less(data["dm"], 350)
+    mask &= np.greater(data["n_clusters"], 5)
+
+    return data[mask]
+
+
+def plot_candidates(
+    data,
+    filename,
+    output_plots,
+    already_filtered=False,
+    cand_file_names=None,
+    fig=None,
+):
     """
     Plot candidate S/N versus DM.
 
     Parameters
     ----------
-    t_data: ~np.record
+    data: ~np.record
     filename: str
         The name of the candidate file.
     output_plots: bool
         Whether to output plots to file, rather than to the screen.
+    already_filtered: bool
+        Whether the RFI candidates were already removed from the data.
+    cand_file_names: list of str
+        Look-up table for the candidate file numbers. If None, all
+        candidates are from `filename`.
+    fig: ~matplotlib.figure.Figure
+        Figure to reuse for plotting. If None, a new figure is created.
     """
 
-    data = np.copy(t_data)
+    if cand_file_names is None:
+        cand_file_names = [filename]
 
     # remove all low-snr candidates and the ones that are really wide
-    data = remove_bad_cands(data)
+    if not already_filtered:
+        data = remove_bad_cands(data)
 
     print("Number of candidates: {0}".format(len(data)))
 
     if not len(data) > 0:
         return
 
-    data = np.sort(data, order=["snr", "dm", "filter"])
+    # sort by snr, then dm, then filter
+    # only the printed columns are reordered, not the full records
+    order = np.lexsort((data["filter"], data["dm"], data["snr"]))
+
+    # format the columns rather than iterating over the records
+    lines = map(
+        "{0}, {1}, {2}, {3}".format,
+        data["snr"][order].tolist(),
+        data["dm"][order].tolist(),
+        data["filter"][order].tolist(),
+        [cand_file_names[i] for i in data["cand_file_nr"][order]],
+    )
+    print("\n".join(lines))
 
-    if len(data) > 0:
-        for item in data:
-            print(
-                "{0}, {1}, {2}, {3}".format(
-                    item["snr"], item["dm"], item["filter"], item["cand_file"]
-                )
-            )
+    if fig is None:
+        fig = plt.figure()
+        reuse_fig = False
+    else:
+        fig.clf()
+        reuse_fig = True
 
-    fig = plt.figure()
     ax = fig.add_subplot(111)
 
-    sc = ax.scatter(data["dm"] + 1, data["snr"], c=data["filter"], marker="o")
-    plt.colorbar(sc, label="Filter number")
+    # draw the candidates of each filter number as one uniformly
+    # coloured marker line, which is faster to render than a scatter
+    cmap = plt.get_cmap()
+    norm = Normalize(vmin=np.min(data["filter"]), vmax=np.max(data["filter"]))
+
+    for filt in np.unique(data["filter"]):
+        mask = data["filter"] == filt
+
+        ax.plot(
+            data["dm"][mask] + 1,
+            data["snr"][mask],
+            color=cmap(norm(filt)),
+            marker="o",
+            linestyle="none",
+            rasterized=True,
+        )
+
+    sm = ScalarMappable(norm=norm, cmap=cmap)
+    fig.colorbar(sm, ax=ax, label="Filter number")
 
     ax.set_xscale("log")
     ax.grid()
     ax.set_xlabel("DM + 1 (pc/cm3)")
     ax.set_ylabel("S/N")
-    ax.set_title("{0}".format(os.path.basename(filename)))
+    basename = os.path.basename(filename)
+    ax.set_title("{0}".format(basename))
 
     fig.tight_layout()
 
     if output_plots:
         fig.savefig(
-            "{0}_snr_dm.png".format(os.path.basename(filename)[0:-5]),
+            "{0}_snr_dm.png".format(basename[0:-5]),
             bbox_inches="tight",
+            dpi=150,
         )
 
         # close the figure in order not
         # to consume too much memory
-        plt.close(fig)
+        if not reuse_fig:
+            plt.close(fig)
 
 
-def plot_clusters(t_data, filename, output_plots):
+def plot_clusters(data, filename, output_plots, fig=None):
     """
     Plot candidate clusters.
 
     Parameters
     ----------
-    t_data: ~np.record
+    data: ~np.record
     filename: str
         The name of the candidate file.
     output_plots: bool
         Whether to output plots to file, rather than to the screen.
+    fig: ~matplotlib.figure.Figure
+        Figure to reuse for plotting. If None, a new figure is created.
     """
 
-    data = np.copy(t_data)
-
     if not len(data) > 0:
         return
 
-    fig = plt.figure()
+    if fig is None:
+        fig = plt.figure()
+        reuse_fig = False
+    else:
+        fig.clf()
+        reuse_fig = True
+
     ax1 = fig.add_subplot(311)
 
-    ax1.scatter(data["dm"], data["n_clusters"])
+    ax1.plot(data["dm"], data["n_clusters"], "o", rasterized=True)
     ax1.grid(True)
     ax1.set_yscale("log")
     ax1.set_xlabel("DM (pc/cm3)")
     ax1.set_ylabel("#clusters")
 
     ax2 = fig.add_subplot(312)
-    ax2.scatter(data["snr"], data["n_clusters"])
+    ax2.plot(data["snr"], data["n_clusters"], "o", rasterized=True)
     ax2.grid(True)
     ax2.set_yscale("log")
     ax2.set_xlabel("S/N")
     ax2.set_ylabel("#clusters")
 
     ax3 = fig.add_subplot(313)
-    ax3.scatter(data["filter"], data["n_clusters"])
+    ax3.plot(data["filter"], data["n_clusters"], "o", rasterized=True)
     ax3.grid(True)
     ax3.set_yscale("log")
     ax3.set_xlabel("Filter number")
@@ -258,69 +387,316 @@ def plot_clusters(t_data, filename, output_plots):
         fig.savefig(
             "{0}_clusters.png".format(os.path.basename(filename)[0:-5]),
             bbox_inches="tight",
+            dpi=150,
         )
 
         # close the figure in order not
         # to consume too much memory
-        plt.close(fig)
+        if not reuse_fig:
+            plt.close(fig)
 
 
-def plot_candidate_timeline(t_data, filename, output_plots):
+def plot_candidate_timeline(
+    data, filename, output_plots, already_filtered=False, fig=None
+):
     """
     Plot candidates as a timeline.
 
     Parameters
     ----------
-    t_data: ~np.record
+    data: ~np.record
     filename: str
         The name of the candidate file.
     output_plots: bool
         Whether to output plots to file, rather than to the screen.
+    already_filtered: bool
+        Whether the RFI candidates were already removed from the data.
+    fig: ~matplotlib.figure.Figure
+        Figure to reuse for plotting. If None, a new figure is created.
     """
 
-    data = np.copy(t_data)
-
     # remove all low-snr candidates and the ones that are really wide
-    data = remove_bad_cands(data)
+    if not already_filtered:
+        data = remove_bad_cands(data)
 
     if not len(data) > 0:
         return
 
-    data = np.sort(data, order="total_time")
+    if fig is None:
+        fig = plt.figure()
+        reuse_fig = False
+    else:
+        fig.clf()
+        reuse_fig = True
 
-    fig = plt.figure()
     ax = fig.add_subplot(111)
 
-    sc = ax.scatter(
-        data["total_time"],
-        data["dm"] + 1,
-        c=2 ** data["filter"],
-        norm=LogNorm(),
-        s=60.0 * data["snr"] / np.max(data["snr"]),
-        marker="o",
-        edgecolor="black",
-        lw=0.6,
-        cmap="Reds",
-    )
-    plt.colorbar(sc, label="Filter number")
+    # the filter number takes only a few distinct values, so draw one
+    # uniformly coloured scatter per filter rather than colour mapping
+    # each point individually
+    cmap = plt.get_cmap("Reds")
+    widths = np.left_shift(1, data["filter"].astype(np.int64))
+    norm = LogNorm(vmin=np.min(widths), vmax=np.max(widths))
+    snr_max = np.max(data["snr"])
+
+    for filt in np.unique(data["filter"]):
+        mask = data["filter"] == filt
+
+        ax.scatter(
+            data["total_time"][mask],
+            data["dm"][mask] + 1,
+            color=cmap(norm(1 << int(filt))),
+            s=60.0 * data["snr"][mask] / snr_max,
+            marker="o",
+            edgecolor="black",
+            lw=0.6,
+            rasterized=True,
+        )
+
+    sm = ScalarMappable(norm=norm, cmap=cmap)
+    fig.colorbar(sm, ax=ax, label="Filter number")
 
     ax.grid()
     ax.set_xlabel("Time (s)")
     ax.set_ylabel("DM + 1 (pc/cm3)")
-    ax.set_title("{0}".format(os.path.basename(filename)))
+    basename = os.path.basename(filename)
+    ax.set_title("{0}".format(basename))
     ax.set_yscale("log")
 
     fig.tight_layout()
 
     if output_plots:
         fig.savefig(
-            "{0}_timeline.png".format(os.path.basename(filename)[0:-5]),
+            "{0}_timeline.png".format(basename[0:-5]),
             bbox_inches="tight",
+            dpi=150,
         )
 
         # close the figure in order not
         # to consume too much memory
-        plt.close(fig)
+        if not reuse_fig:
+            plt.close(fig)
+
+
+def get_tmp_dir():
+    """
+    Get the directory in which to create temporary files.
+
+    Returns
+    -------
+    tmp_dir : str or None
+        The memory-backed /dev/shm if available, otherwise None, i.e. the
+        system default.
+    """
+
+    if os.path.isdir("/dev/shm"):
+        tmp_dir = "/dev/shm"
+    else:
+        tmp_dir = None
+
+    return tmp_dir
+
+
+def _read_sigproc_value(f, fmt):
+    """
+    Read a binary value from a sigproc header.
+
+    Parameters
+    ----------
+    f : file object
+        Filterbank file opened in binary mode.
+    fmt : str
+        The struct format character of the value.
+
+    Returns
+    -------
+    value : int or float
+        The value.
+
+    Raises
+    ------
+    RuntimeError
+        If the header is truncated.
+    """
+
+    fmt = "<{0}".format(fmt)
+    size = struct.calcsize(fmt)
+    raw = f.read(size)
+
+    if len(raw) != size:
+        raise RuntimeError("Truncated sigproc header: {0}".format(f.name))
+
+    (value,) = struct.unpack(fmt, raw)
+
+    return value
+
+
+def _read_sigproc_string(f):
+    """
+    Read a length-prefixed string from a sigproc header.
+
+    Parameters
+    ----------
+    f : file object
+        Filterbank file opened in binary mode.
+
+    Returns
+    -------
+    value : str
+        The string.
+
+    Raises
+    ------
+    RuntimeError
+        If the header is truncated or the string is invalid.
+    """
+
+    length = _read_sigproc_value(f, "i")
+
+    if not 0 < length < 80:
+        raise RuntimeError("Invalid sigproc header string length: {0}".format(length))
+
+    raw = f.read(length)
+
+    if len(raw) != length:
+        raise RuntimeError("Truncated sigproc header: {0}".format(f.name))
+
+    try:
+        value = raw.decode("ascii")
+    except UnicodeDecodeError:
+        raise RuntimeError("Invalid sigproc header string: {0}".format(raw))
+
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def _read_sigproc_header(fil_file, mtime):
+    """
+    Parse the header of a sigproc filterbank file.
+
+    The modification time is part of the cache key only, so that a
+    rewritten file gets parsed again.
+
+    Parameters
+    ----------
+    fil_file : str
+        Filterbank file name.
+    mtime : float
+        Modification time of the file.
+
+    Returns
+    -------
+    header : dict
+        The header keywords and their values, plus the header length in
+        bytes as `header_size`.
+    """
+
+    header = {}
+
+    with open(fil_file, "rb") as f:
+        if _read_sigproc_string(f) != "HEADER_START":
+            raise RuntimeError("Not a sigproc filterbank file: {0}".format(fil_file))
+
+        while True:
+            key = _read_sigproc_string(f)
+
+            if key == "HEADER_END":
+                break
+            elif key in ["FREQUENCY_START", "FREQUENCY_END"]:
+                continue
+            elif key not in _SIGPROC_KEYS:
+                raise RuntimeError("Unknown sigproc header keyword: {0}".format(key))
+
+            fmt = _SIGPROC_KEYS[key]
+
+            if fmt == "s":
+                header[key] = _read_sigproc_string(f)
+            else:
+                header[key] = _read_sigproc_value(f, fmt)
+
+        header["header_size"] = f.tell()
+
+    return header
+
+
+def get_fil_header(fil_file):
+    """
+    Read the relevant parameters from a filterbank file header.
+
+    The header is parsed in Python and cached, as all candidates from a
+    filterbank file share the same header.
+
+    Parameters
+    ----------
+    fil_file : str
+        Filterbank file name.
+
+    Returns
+    -------
+    header : tuple
+        Sampling time (s), observation length (s), start MJD, number of
+        channels, channel offset (MHz) and first channel frequency (MHz).
+
+    Raises
+    ------
+    RuntimeError
+        If the header is invalid or lacks a required keyword.
+    """
+
+    header = _read_sigproc_header(fil_file, os.path.getmtime(fil_file))
+
+    for key in ["tsamp", "tstart", "nchans", "nbits", "foff", "fch1"]:
+        if key not in header:
+            raise RuntimeError("Filterbank header lacks {0}: {1}".format(key, fil_file))
+
+    if not (header["nchans"] > 0 and header["nbits"] > 0):
+        raise RuntimeError("Invalid filterbank header: {0}".format(fil_file))
+
+    samp_time = header["tsamp"]
+    nchan = header["nchans"]
+
+    # the number of samples follows from the size of the data block
+    nbytes = os.path.getsize(fil_file) - header["header_size"]
+    nsamp = (8 * nbytes) // (header["nbits"] * nchan * header.get("nifs", 1))
+    tobs = nsamp * samp_time
+
+    return samp_time, tobs, header["tstart"], nchan, header["foff"], header["fch1"]
+
+
+def get_dm_smearing(freq, bw, nchan, dm):
+    """
+    Compute the dispersive smearing within a frequency channel.
+
+    As in dmsmear, this is the exact dispersion delay across the lowest
+    frequency channel, where the smearing is largest.
+
+    Parameters
+    ----------
+    freq : float
+        Centre frequency in MHz.
+    bw : float
+        Total bandwidth in MHz.
+    nchan : int
+        Number of frequency channels.
+    dm : float
+        Dispersion measure in pc/cm3.
+
+    Returns
+    -------
+    smear : float
+        Intra-channel dispersion smearing in seconds.
+    """
+
+    # dispersion constant in s MHz^2 cm^3 / pc
+    k_dm = 4.148808e3
+
+    chan_bw = abs(bw) / nchan
+    f_lo = freq - 0.5 * abs(bw)
+    f_hi = f_lo + chan_bw
+
+    smear = k_dm * dm * (f_lo**-2 - f_hi**-2)
+
+    return smear
 
 
 def get_zap_file(zap_mode):
@@ -340,31 +716,15 @@ def get_zap_file(zap_mode):
     Raises
     ------
     RuntimeError
-        If zap file does not exist.
+        If zap mode is unknown or zap file does not exist.
     """
 
     zap_mask_dir = os.path.join(os.path.dirname(__file__), "zap_masks")
 
-    if zap_mode == "None":
-        # no zapping
-        zap_file = os.path.join(zap_mask_dir, "none.psh")
-
-    elif zap_mode == "Lovell_20cm":
-        # Lovell 20cm data
-        # this works for 672 and 800 channel data
-        zap_file = os.path.join(zap_mask_dir, "Lovell_20cm.psh")
-
-    elif zap_mode == "Lovell_80cm":
-        # Lovell 80cm data
-        # currently untested
-        zap_file = os.path.join(zap_mask_dir, "Lovell_80cm.psh")
-
-    elif zap_mode == "MeerKAT_20cm":
-        # MeerKAT L-band 1024 channel data
-        zap_file = os.path.join(zap_mask_dir, "MeerKAT_20cm.psh")
-
-    else:
-        RuntimeError("Zap mask mode unknown: {0}".format(zap_mode))
+    try:
+        zap_file = os.path.join(zap_mask_dir, _ZAP_FILES[zap_mode])
+    except KeyError:
+        raise RuntimeError("Zap mask mode unknown: {0}".format(zap_mode))
 
     if not os.path.isfile(zap_file):
         raise RuntimeError("The zap mask file does not exist: {0}".format(zap_file))
@@ -380,13 +740,19 @@ def plot_candidate_dspsr(
     filter,
     dm,
     snr,
-    zap_mode,
+    zap_file,
     nchan=0,
     nbin=0,
     length=0,
+    workdir=None,
 ):
     """
     Plot a candidate using dspsr.
+
+    `zap_file` is the absolute name of the psrsh zap file to use, as
+    returned by `get_zap_file`. If `workdir` is given, the archive is
+    written directly into it under a name unique to the candidate,
+    otherwise a new temporary directory is created.
     """
 
     log = logging.getLogger("hdpipe.candviewer")
@@ -395,22 +761,7 @@ def plot_candidate_dspsr(
         raise RuntimeError("Filterbank file does not exist: {0}".format(fil_file))
 
     # determine data parameters
-    command = "header {0} -tsamp -tobs -tstart -nchans -foff -fch1".format(fil_file)
-    args = shlex.split(command)
-    try:
-        raw = subprocess.check_output(args, encoding="ascii")
-    except TypeError as e:
-        log.error("Could not run header command: {0}".format(str(e)))
-        raw = subprocess.check_output(args)
-
-    info = raw.split("\n")
-
-    samp_time = float(info[0].strip()) * 1e-6
-    tobs = float(info[1].strip())
-    tstart = float(info[2].strip())
-    rec_nchan = int(info[3].strip())
-    foff = float(info[4].strip())
-    fch1 = float(info[5].strip())
+    samp_time, tobs, tstart, rec_nchan, foff, fch1 = get_fil_header(fil_file)
     rec_bw = float(abs(foff * rec_nchan))
     rec_cfreq = float(fch1 + 0.5 * rec_nchan * foff)
 
@@ -419,32 +770,24 @@ def plot_candidate_dspsr(
     cand_mjd = float(tstart + cand_time / (60 * 60 * 24.0))
 
     log.info(
-        "Data parameters: {0}, {1}, {2}, {3}, {4}, {5} MJD".format(
-            samp_time, tobs, rec_cfreq, rec_nchan, rec_bw, tstart
-        )
+        "Data parameters: %s, %s, %s, %s, %s, %s MJD",
+        samp_time,
+        tobs,
+        rec_cfreq,
+        rec_nchan,
+        rec_bw,
+        tstart,
     )
-    log.info("Candidate parameters: {0} s, {1} MJD".format(cand_time, cand_mjd))
+    log.info("Candidate parameters: %s s, %s MJD", cand_time, cand_mjd)
 
     # use the absolute path here
     fil_file = os.path.abspath(fil_file)
 
-    command = "dmsmear -f {0} -b {1} -n {2} -d {3} -q".format(
-        rec_cfreq, rec_bw, rec_nchan, dm
-    )
-    args = shlex.split(command)
-    try:
-        result = subprocess.check_output(
-            args, stderr=subprocess.STDOUT, encoding="ascii"
-        )
-    except TypeError as e:
-        log.error("Could not run dmsmear command: {0}".format(str(e)))
-        result = subprocess.check_output(args, stderr=subprocess.STDOUT)
-
-    cand_band_smear = float(result.strip())
-    log.info("Candidate band smearing: {0}".format(cand_band_smear))
+    cand_band_smear = get_dm_smearing(rec_cfreq, rec_bw, rec_nchan, dm)
+    log.info("Candidate band smearing: %s", cand_band_smear)
 
-    cand_filter_time = (2**filter) * samp_time
-    log.info("Filter, cand_filter_time: {0}, {1}".format(filter, cand_filter_time))
+    cand_filter_time = (1 << int(filter)) * samp_time
+    log.info("Filter, cand_filter_time: %s, %s", filter, cand_filter_time)
 
     cand_smearing = float(cand_band_smear) + float(cand_filter_time)
     cand_start_time = cand_time - 0.5 * cand_smearing
@@ -464,83 +807,85 @@ def plot_candidate_dspsr(
     if nbin > 1024:
         nbin = 1024
 
+    # name the archive after the candidate and its utc start time, so
+    # that the candidates do not clash in a shared working directory
+    start_mjd = tstart + cand_start_time / (60 * 60 * 24.0)
+    start_utc = datetime(1858, 11, 17) + timedelta(days=start_mjd)
+    start_utc = start_utc.strftime("%Y-%m-%d-%H:%M:%S")
+    archive_base = "c{0:0>4}_{1}".format(cand_nr, start_utc)
+
     # construct dspsr command
-    command = "dspsr -k MEERKAT {fil_file} -S {cand_start_time} -b {nbin} -T {cand_tot_time} -c {cand_tot_time} -D {dm}".format(
+    command = "dspsr -k MEERKAT {fil_file} -S {cand_start_time} -b {nbin} -T {cand_tot_time} -c {cand_tot_time} -D {dm} -U 1 -cepoch start -O {archive_base} -q -Q".format(
         fil_file=fil_file,
         cand_start_time=cand_start_time,
         nbin=nbin,
         cand_tot_time=cand_tot_time,
         dm=dm,
+        archive_base=archive_base,
     )
-    command += " -U 1 -cepoch start -q -Q"
-
-    log.info("Dspsr command: {0}".format(command))
-
-    # create a temporary working directory
-    workdir = tempfile.mkdtemp()
-    log.info("Workdir: {0}".format(workdir))
-
-    args = shlex.split(command)
-    try:
-        result = subprocess.check_output(
-            args, stderr=subprocess.STDOUT, encoding="ascii", cwd=workdir
-        )
-    except TypeError as e:
-        log.error("Could not run dspsr command: {0}".format(str(e)))
-        result = subprocess.check_output(args, stderr=subprocess.STDOUT, cwd=workdir)
 
-    archive = result.split("seconds: ")[1]
-    archive = archive.strip()
-    archive = os.path.join(workdir, "{0}.ar".format(archive))
-    log.debug(archive)
-
-    count = 10
-    while (not os.path.exists(archive)) and count > 0:
-        log.warn("Archive file does not exist: {0}".format(archive))
-        sleep(1)
-        count = count - 1
+    log.info("Dspsr command: %s", command)
 
     if nchan == 0:
         # determine number of channels based on SNR
-        nchan = int(round(math.pow(float(snr) / 4.0, 2)))
+        nchan = int(round((float(snr) / 4.0) ** 2))
     if nchan < 2:
         nchan = 2
 
     # round nchan to closest power of 2
     # nchan_base2 = int(round(math.log(nchan, 2)))
-    # nchan = math.pow(2,nchan_base2)
+    # nchan = 1 << nchan_base2
 
     if nchan > 512:
         nchan = 512
 
-    # get the zap file to use
-    zap_file = get_zap_file(zap_mode)
-    if not os.path.isfile(zap_file):
-        raise RuntimeError("The zap file does not exist: {0}".format(zap_file))
+    with contextlib.ExitStack() as stack:
+        # work in the shared session directory if given, otherwise in a
+        # temporary directory of our own
+        if workdir is None:
+            workdir = stack.enter_context(
+                tempfile.TemporaryDirectory(dir=get_tmp_dir())
+            )
 
-    info_str_l = r"Cand {cand_nr}\n{file}\n{mjd:.5f}\n$coord".format(
-        cand_nr=cand_nr, file=os.path.basename(archive)[0:-3], mjd=cand_mjd
-    )
+        log.info("Workdir: %s", workdir)
+
+        archive = os.path.join(workdir, "{0}.ar".format(archive_base))
+
+        # remove the archive once plotted, as the workdir can be memory-backed
+        def remove_archive():
+            if os.path.isfile(archive):
+                os.remove(archive)
 
-    log.info(info_str_l)
+        stack.callback(remove_archive)
 
-    info_str_r = (
-        r"S/N {snr:.1f}; DM {dm:.1f}; w {width:.1f} ms\n{fil_file}\n{cand_file}".format(
-            snr=snr,
-            dm=dm,
-            width=cand_filter_time * 1e3,
-            fil_file=os.path.basename(fil_file),
-            cand_file=os.path.basename(cand_file),
+        args = shlex.split(command)
+        subprocess.check_call(args, cwd=workdir)
+
+        # dspsr has finished at this point, so there is no need to wait
+        if not os.path.isfile(archive):
+            raise RuntimeError("Archive file does not exist: {0}".format(archive))
+
+        info_str_l = r"Cand {cand_nr}\n{file}\n{mjd:.5f}\n$coord".format(
+            cand_nr=cand_nr, file=start_utc, mjd=cand_mjd
         )
-    )
 
-    log.info(info_str_r)
+        log.info(info_str_l)
 
-    outfile = os.path.join(
-        ".", "c{0:0>4}_{1}.png".format(cand_nr, os.path.basename(archive)[0:-3])
-    )
+        info_str_r = (
+            r"S/N {snr:.1f}; DM {dm:.1f}; w {width:.1f} ms\n{fil_file}\n{cand_file}".format(
+                snr=snr,
+                dm=dm,
+                width=cand_filter_time * 1e3,
+                fil_file=os.path.basename(fil_file),
+                cand_file=os.path.basename(cand_file),
+            )
+        )
 
-    command = """\
+        log.info(info_str_r)
+
+        outfile = os.path.join(".", "{0}.png".format(archive_base))
+
+        command = """\
 psrplot -p freq+
 -J {zap_file} -j 'F {nchan:.0f}'
 -c above:l='{info_str_l}'
@@ -549,23 +894,17 @@ psrplot -p freq+
 -c x:unit=ms
 -c y:reverse=1
 -D {outfile}/PNG {archive}""".format(
-        zap_file=zap_file,
-        nchan=nchan,
-        info_str_l=info_str_l,
-        info_str_r=info_str_r,
-        outfile=outfile,
-        archive=archive,
-    )
-
-    log.info("Psrplot command: {0}".format(command))
-    args = shlex.split(command)
-    subprocess.check_call(args)
-
-    # clean up
-    if os.path.exists(archive):
-        os.remove(archive)
+            zap_file=zap_file,
+            nchan=nchan,
+            info_str_l=info_str_l,
+            info_str_r=info_str_r,
+            outfile=outfile,
+            archive=archive,
+        )
 
-    os.rmdir(workdir)
+        log.info("Psrplot command: %s", command)
+        args = shlex.split(command)
+        subprocess.check_call(args)
 
 
 #
@@ -585,81 +924,144 @@ def main():
     # sanity check
     for item in args.candfiles:
         if not os.path.isfile(item):
-            log.error("The file does not exist: {0}".format(item))
+            log.error("The file does not exist: %s", item)
             sys.exit(1)
 
     if not args.nchan >= 2:
-        log.error("Nchan must be greater than 2: {0}".format(args.nchan))
+        log.error("Nchan must be greater than 2: %s", args.nchan)
         sys.exit(1)
 
-    candfiles = np.sort(args.candfiles)
+    candfiles = sorted(args.candfiles)
 
-    data = None
+    print("Loading candidate files: {0}".format(len(candfiles)))
+    sys.stdout.flush()
 
-    for icand, item in enumerate(candfiles):
-        print("Processing: {0}".format(item))
-        part = load_data(item)
+    # parse the candidate files in parallel, numpy releases the gil
+    # while parsing and reading
+    nworker = min(len(candfiles), len(os.sched_getaffinity(0)))
 
-        part["cand_file"] = item
-        part["fil_file"] = "{0}.fil".format(item[0:-5])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nworker) as ex:
+        loaded = list(
+            ex.map(functools.partial(load_data, use_cache=args.cache), candfiles)
+        )
+
+    # look-up tables for the file names, the candidate data
+    # only store integer indices into these
+    cand_file_names = []
+    fil_file_names = []
+
+    parts = []
+
+    # register the files in order, so that the indices are deterministic
+    for icand, (item, part) in enumerate(zip(candfiles, loaded)):
+        print("Filtering: {0}".format(item))
+
+        cand_file_names.append(item)
+        part["cand_file_nr"] = len(cand_file_names) - 1
+
+        fil_file_names.append("{0}.fil".format(item[0:-5]))
+        part["fil_file_nr"] = len(fil_file_names) - 1
         # XXX: do not hardcode time here
         part["total_time"] = part["time"] + (icand - 1) * 60.0
 
-        # part = remove_bad_cands(part)
-
         # plot_clusters(part, item, args.output)
-        # plot_candidates(part, item, args.output)
-        # plot_candidate_timeline(part, item, args.output)
 
-        if data is None:
-            data = np.copy(part)
-        else:
-            data = np.concatenate((data, part))
+        # remove all low-snr candidates and the ones that are really wide
+        # do this per file, so that only the good candidates get merged
+        part = remove_bad_cands(part)
 
-    # remove all low-snr candidates and the ones that are really wide
-    good = remove_bad_cands(data)
+        # plot_candidates(
+        #     part,
+        #     item,
+        #     args.output,
+        #     already_filtered=True,
+        #     cand_file_names=cand_file_names,
+        # )
+        # plot_candidate_timeline(part, item, args.output, already_filtered=True)
+
+        parts.append(part)
+
+    # merge all candidates into a single pre-sized array
+    total = sum(len(part) for part in parts)
+    data = np.empty(total, dtype=parts[0].dtype)
+
+    offset = 0
+    for part in parts:
+        data[offset : offset + len(part)] = part
+        offset += len(part)
+
+    good = data
     print("Number of good candidates: {0}".format(len(good)))
 
     # sort candidates by snr for plotting
-    good = np.sort(good, order="snr")
-    good = np.flipud(good)
-
-    sleep(3)
+    # in descending order, in a single reordering step
+    good = good[np.argsort(-good["snr"], kind="stable")]
 
     print("Plotting good candidates.")
 
     # sanity check
-    for item in good:
-        if os.path.isfile(item["cand_file"]) and os.path.isfile(item["fil_file"]):
-            pass
-        else:
-            raise RuntimeError(
-                "Cand or fil file do not exist: {0}, {1}".format(
-                    item["cand_file"], item["fil_file"]
-                )
-            )
-
-    cand_nr = 1
-
-    for item in good:
-        try:
-            plot_candidate_dspsr(
-                item["fil_file"],
-                item["cand_file"],
-                cand_nr,
-                item["samp_nr"],
-                item["filter"],
-                item["dm"],
-                item["snr"],
-                args.zap_mode,
-                nchan=args.nchan,
-            )
-        except subprocess.CalledProcessError as e:
-            print("An error occurred: {0}".format(str(e)))
+    # only check each file once, not once per candidate
+    files = [cand_file_names[i] for i in np.unique(good["cand_file_nr"])]
+    files += [fil_file_names[i] for i in np.unique(good["fil_file_nr"])]
 
-        cand_nr += 1
+    for item in files:
+        if not os.path.isfile(item):
+            raise RuntimeError("Cand or fil file does not exist: {0}".format(item))
 
-    print("Plotted dynamic spectra: {0}".format(cand_nr))
+    # get the zap file to use
+    zap_file = get_zap_file(args.zap_mode)
+
+    # extract the columns once, rather than per record
+    fil_file_nrs = good["fil_file_nr"]
+    cand_file_nrs = good["cand_file_nr"]
+    samp_nrs = good["samp_nr"]
+    filters = good["filter"]
+    dms = good["dm"]
+    snrs = good["snr"]
+
+    # use one temporary directory for the whole session
+    # the work is done in external programs, so threads are sufficient
+    with tempfile.TemporaryDirectory(dir=get_tmp_dir()) as workdir:
+        # use the number of cpus that the process may run on, e.g. as
+        # allocated by the batch scheduler
+        nworker = len(os.sched_getaffinity(0))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nworker) as ex:
+            futures = [
+                ex.submit(
+                    plot_candidate_dspsr,
+                    fil_file_names[fil_file_nrs[i]],
+                    cand_file_names[cand_file_nrs[i]],
+                    i + 1,
+                    samp_nrs[i],
+                    filters[i],
+                    dms[i],
+                    snrs[i],
+                    zap_file,
+                    nchan=args.nchan,
+                    workdir=workdir,
+                )
+                for i in range(len(good))
+            ]
+
+            nplotted = 0
+
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        future.result()
+                    except (subprocess.CalledProcessError, RuntimeError) as e:
+                        print("An error occurred: {0}".format(str(e)))
+                    else:
+                        nplotted += 1
+            except BaseException:
+                # do not start any further candidates, e.g. after ctrl-c
+                # the executor would otherwise run all queued ones on exit
+                for future in futures:
+                    future.cancel()
+                raise
+
+    print("Plotted dynamic spectra: {0}".format(nplotted))
 
     print("All done.")
 
@@ -4,18 +4,17 @@
 #
 
 import argparse
-import glob
+import concurrent.futures
 import logging
 import os
 import shlex
+import shutil
 import signal
 import subprocess
 import sys
 import tempfile
+import threading
 from time import sleep
-import sys
-
-import numpy as np
 
 from hdpipe.general_helpers import signal_handler, setup_logging
 from hdpipe.version import __version__
@@ -52,11 +51,12 @@ def parse_args():
     parser.add_argument(
         "-g",
         "--gpu_id",
-        dest="gpu_id",
+        dest="gpu_ids",
         type=int,
+        action="append",
         choices=[0, 1],
-        default=0,
-        help="ID of GPU to use.",
+        default=None,
+        help="ID of GPU to use. Repeat to spread the files over GPUs. Uses 0 if unset.",
     )
 
     parser.add_argument(
@@ -73,6 +73,10 @@ def parse_args():
 
     args = parser.parse_args()
 
+    # use the first gpu unless specified
+    if args.gpu_ids is None:
+        args.gpu_ids = [0]
+
     return args
 
 
@@ -104,14 +108,14 @@ def get_zap_str(zap_mode):
         zap_str = "-zap_chans 0 27 -zap_chans 82 124 -zap_chans 376 391 -zap_chans 413 519 -zap_chans 801 833 -zap_chans 841 845 -zap_chans 858 862 -zap_chans 874 879 -zap_chans 909 921 -zap_chans 1010 1023"
 
     else:
-        RuntimeError("Zap mode does not exist: {0}".format(zap_mode))
+        raise RuntimeError("Zap mode does not exist: {0}".format(zap_mode))
 
     return zap_str
 
 
-def run_heimdall(filename, gpu_id, zap_mode, dm_max):
+def launch_heimdall(filename, gpu_id, zap_str, dm_max):
     """
-    Run heimdall on a filterbank file.
+    Start heimdall on a filterbank file without waiting for it.
 
     Parameters
     ----------
@@ -119,10 +123,16 @@ def run_heimdall(filename, gpu_id, zap_mode, dm_max):
         Filenames of filterbank files to process.
     gpu_id: int
         ID of GPU to use.
-    zap_mode: str
-        Frequency zap mask to use.
+    zap_str: str
+        Frequency zap mask string for heimdall.
     dm_max: float
         The maximum DM to search out to.
+
+    Returns
+    -------
+    job: tuple
+        The heimdall process, its temporary output directory and the
+        output candidate file name.
     """
 
     log = logging.getLogger("hdpipe.run_heimdall")
@@ -130,39 +140,165 @@ def run_heimdall(filename, gpu_id, zap_mode, dm_max):
     if not os.path.isfile(filename):
         raise RuntimeError("The file does not exist: {0}".format(filename))
 
-    # get the frequency zap mask string
-    zap_str = get_zap_str(zap_mode)
+    outfile = "{0}.cand".format(os.path.splitext(filename)[0])
 
-    tempdir = tempfile.mkdtemp()
-    log.info("Temp dir: {0}".format(tempdir))
+    tempdir = tempfile.TemporaryDirectory()
+    log.info("Temp dir: %s", tempdir.name)
 
     command = "heimdall -dm 0 {dm_max} -dm_tol 1.05 -output_dir {outdir} {zap_str} -gpu_id {gpu_id} -f {filename}".format(
-        outdir=tempdir, zap_str=zap_str, gpu_id=gpu_id, filename=filename, dm_max=dm_max
+        outdir=tempdir.name,
+        zap_str=zap_str,
+        gpu_id=gpu_id,
+        filename=filename,
+        dm_max=dm_max,
     )
 
-    log.info("Heimdall command: {0}".format(command))
+    log.info("Heimdall command: %s", command)
     sys.stdout.flush()
 
     args = shlex.split(command)
-    subprocess.check_call(args)
 
-    candfiles = glob.glob(os.path.join(tempdir, "*.cand"))
-    total = ""
+    try:
+        proc = subprocess.Popen(args)
+    except Exception:
+        tempdir.cleanup()
+        raise
 
-    for item in candfiles:
-        with open(item, "r") as f:
-            total += f.read()
+    return proc, tempdir, outfile
 
-    outfile = "{0}.cand".format(os.path.splitext(filename)[0])
 
-    with open(outfile, "w") as f:
-        f.write(total)
+def finalize_heimdall(proc, tempdir, outfile):
+    """
+    Wait for a heimdall run to finish and gather its candidates.
+
+    Parameters
+    ----------
+    proc: subprocess.Popen
+        The heimdall process.
+    tempdir: tempfile.TemporaryDirectory
+        The temporary output directory of the run. It gets removed.
+    outfile: str
+        Name of the output candidate file.
+    """
+
+    try:
+        proc.wait()
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
 
-    # clean up
-    for item in candfiles:
-        os.remove(item)
+        # stream the candidate files into the output file
+        with open(outfile, "wb") as f_out, os.scandir(tempdir.name) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".cand"):
+                    continue
+
+                with open(entry.path, "rb") as f_in:
+                    shutil.copyfileobj(f_in, f_out, 1 << 20)
+
+    finally:
+        tempdir.cleanup()
+
+
+def run_heimdall(filename, gpu_id, zap_str, dm_max):
+    """
+    Run heimdall on a filterbank file.
+
+    Parameters
+    ----------
+    filename: str
+        Filenames of filterbank files to process.
+    gpu_id: int
+        ID of GPU to use.
+    zap_str: str
+        Frequency zap mask string for heimdall.
+    dm_max: float
+        The maximum DM to search out to.
+    """
 
-    os.rmdir(tempdir)
+    job = launch_heimdall(filename, gpu_id, zap_str, dm_max)
+    finalize_heimdall(*job)
+
+
+def process_files(files, gpu_id, zap_str, dm_max, stop_event=None):
+    """
+    Run heimdall on several filterbank files in turn on one GPU.
+
+    The candidates of each run are gathered while heimdall already
+    processes the next file. Once `stop_event` is set, the running
+    heimdall instance is terminated and no further files are processed.
+
+    Parameters
+    ----------
+    files: list of str
+        Filenames of filterbank files to process.
+    gpu_id: int
+        ID of GPU to use.
+    zap_str: str
+        Frequency zap mask string for heimdall.
+    dm_max: float
+        The maximum DM to search out to.
+    stop_event: ~threading.Event
+        Event that signals to stop processing.
+
+    Returns
+    -------
+    nsuccess: int
+        The number of successfully processed files.
+    """
+
+    log = logging.getLogger("hdpipe.run_heimdall")
+
+    if stop_event is None:
+        stop_event = threading.Event()
+
+    nsuccess = 0
+    pending = None
+
+    for item in files + [None]:
+        # only run one heimdall instance on the gpu at a time
+        if pending is not None:
+            proc = pending[1][0]
+
+            while True:
+                try:
+                    proc.wait(timeout=1)
+                except subprocess.TimeoutExpired:
+                    if stop_event.is_set():
+                        proc.terminate()
+                else:
+                    break
+
+        if stop_event.is_set():
+            log.warning("Stopping, skipping the remaining files on GPU %s.", gpu_id)
+            item = None
+
+        job = None
+
+        if item is not None:
+            print("Processing: {0} (GPU {1})".format(item, gpu_id))
+            sys.stdout.flush()
+
+            try:
+                job = launch_heimdall(item, gpu_id, zap_str, dm_max)
+            except Exception as e:
+                log.error("Heimdall failed on file: %s, %s", item, e)
+
+        # gather the candidates of the previous run in the meantime
+        if pending is not None:
+            try:
+                finalize_heimdall(*pending[1])
+            except Exception as e:
+                log.error("Heimdall failed on file: %s, %s", pending[0], e)
+            else:
+                nsuccess += 1
+
+        pending = None if job is None else (item, job)
+
+        if item is None:
+            break
+
+    return nsuccess
 
 
 #
@@ -182,29 +318,48 @@ def main():
     # sanity check
     for item in args.files:
         if not os.path.isfile(item):
-            log.error("The file does not exist: {0}".format(item))
+            log.error("The file does not exist: %s", item)
             sys.exit(1)
 
-    files = np.sort(args.files)
+    files = sorted(args.files)
+
+    # get the frequency zap mask string
+    zap_str = get_zap_str(args.zap_mode)
 
     print("Number of files to process: {0}".format(len(files)))
-    print("Using GPU: {0}".format(args.gpu_id))
+    print("Using GPUs: {0}".format(args.gpu_ids))
     print("Zap mode: {0}".format(args.zap_mode))
     sys.stdout.flush()
     sleep(3)
 
-    i = 0
-
-    for item in files:
-        print("Processing: {0}".format(item))
-        sys.stdout.flush()
+    # distribute the files round-robin across the gpus, each gpu
+    # processes its share in turn, so that it only runs one heimdall
+    # instance at a time
+    gpu_ids = sorted(set(args.gpu_ids))
+    ngpu = len(gpu_ids)
+
+    stop_event = threading.Event()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ngpu) as ex:
+        futures = [
+            ex.submit(
+                process_files,
+                files[igpu::ngpu],
+                gpu_id,
+                zap_str,
+                args.dm_max,
+                stop_event=stop_event,
+            )
+            for igpu, gpu_id in enumerate(gpu_ids)
+        ]
 
         try:
-            run_heimdall(item, args.gpu_id, args.zap_mode, args.dm_max)
-        except Exception as e:
-            log.error("Heimdall failed on file: {0}, {1}".format(item, str(e)))
-        else:
-            i += 1
+            i = sum(future.result() for future in futures)
+        except BaseException:
+            # let the workers stop, e.g. after ctrl-c, otherwise the
+            # executor waits for them to process all their files on exit
+            stop_event.set()
+            raise
 
     print("Successfully processed files: {0} ({1})".format(i, len(files)))
 
@@ -3,7 +3,10 @@
 # 2020 Fabian Jankowski
 #
 
+import argparse
+import concurrent.futures
 import glob
+import multiprocessing
 import os.path
 import shlex
 import subprocess
@@ -14,9 +17,91 @@ import numpy as np
 from psrfits2fil import main as presto_convert
 
 
-def integrate_psrfits():
+def parse_args():
+    """
+    Parse the commandline arguments.
+
+    Returns
+    -------
+    args: populated namespace
+        The commandline arguments.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Preprocess the MeerTime search mode data."
+    )
+
+    parser.add_argument(
+        "--nproc",
+        dest="nproc",
+        type=int,
+        default=None,
+        help="Number of jobs to run in parallel (default: allocated CPUs).",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def get_nproc(nproc, njob):
+    """
+    Get the number of jobs to run in parallel.
+
+    Parameters
+    ----------
+    nproc: int
+        Requested number of parallel jobs. If None, use the number of CPUs
+        the process may run on, e.g. as allocated by the scheduler.
+    njob: int
+        Total number of jobs.
+
+    Returns
+    -------
+    nproc: int
+        Number of jobs to run in parallel.
+    """
+
+    if nproc is None:
+        nproc = len(os.sched_getaffinity(0))
+
+    nproc = max(1, min(nproc, njob))
+
+    return nproc
+
+
+def combine_psrfits(files_to_process):
+    """
+    Combine consecutive PSRFITS files into a single one.
+
+    Parameters
+    ----------
+    files_to_process: list of str
+        The PSRFITS files to combine.
+    """
+
+    outfile = os.path.join(".", os.path.basename(files_to_process[0]))
+    outfile = os.path.abspath(outfile)
+    print("Output file: {0}".format(outfile))
+    sys.stdout.flush()
+
+    command = "pfitsUtil_searchmode_combineTime -o {outfile} {filestr}".format(
+        outfile=outfile, filestr=" ".join(files_to_process)
+    )
+
+    args = shlex.split(command)
+
+    subprocess.check_call(args)
+
+
+def integrate_psrfits(nproc=None):
     """
     Integrate single PSRFITS files into longer ones
+
+    Parameters
+    ----------
+    nproc: int
+        Number of batches to combine in parallel, see `get_nproc`.
     """
 
     dirs = glob.glob("/fred/oz005/search/J1935+2154/2020-05-1*")
@@ -38,34 +123,34 @@ def integrate_psrfits():
         step = 30
         nbatch = int(np.ceil(len(files) / float(step)))
 
-        for ibatch in range(nbatch):
-            start = ibatch * step
-            end = (ibatch + 1) * step
-
-            if end >= len(files):
-                end = len(files) - 1
+        batches = []
 
-            files_to_process = files[start:end]
+        for ibatch in range(nbatch):
+            # slicing clips at the end of the list
+            files_to_process = files[ibatch * step : (ibatch + 1) * step]
             print("Files to process: {0}".format(len(files_to_process)))
 
-            outfile = os.path.join(".", os.path.basename(files_to_process[0]))
-            outfile = os.path.abspath(outfile)
-            print("Output file: {0}".format(outfile))
-            sys.stdout.flush()
+            batches.append(files_to_process)
 
-            command = "pfitsUtil_searchmode_combineTime -o {outfile} {filestr}".format(
-                outfile=outfile, filestr=" ".join(files_to_process)
-            )
+        nworker = get_nproc(nproc, len(batches))
+        print("Parallel batches: {0}".format(nworker))
+        sys.stdout.flush()
 
-            args = shlex.split(command)
+        # the batches are independent, combine several of them at once
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nworker) as ex:
+            list(ex.map(combine_psrfits, batches))
 
-            subprocess.check_call(args)
-            sys.stdout.flush()
+        sys.stdout.flush()
 
 
-def convert_to_filterbank():
+def convert_to_filterbank(nproc=None):
     """
     Convert the psrfits data to sigproc filterbank files.
+
+    Parameters
+    ----------
+    nproc: int
+        Number of files to convert in parallel, see `get_nproc`.
     """
 
     files = glob.glob(os.path.join(".", "2*.sf"))
@@ -78,14 +163,23 @@ def convert_to_filterbank():
     apply_scales = True
     apply_offsets = True
 
+    jobs = []
+
     for item in files:
         infile = os.path.abspath(item)
         outfile = "{0}.fil".format(infile)
 
-        presto_convert(
-            infile, outfile, nbit, apply_weights, apply_scales, apply_offsets
+        jobs.append(
+            (infile, outfile, nbit, apply_weights, apply_scales, apply_offsets)
         )
 
+    nproc = get_nproc(nproc, len(jobs))
+    print("Parallel conversions: {0}".format(nproc))
+
+    # the conversion is cpu bound, convert one file per allocated core
+    with multiprocessing.Pool(nproc) as pool:
+        pool.starmap(presto_convert, jobs)
+
 
 #
 # MAIN
@@ -93,8 +187,10 @@ def convert_to_filterbank():
 
 
 def main():
-    integrate_psrfits()
-    convert_to_filterbank()
+    args = parse_args()
+
+    integrate_psrfits(nproc=args.nproc)
+    convert_to_filterbank(nproc=args.nproc)
 
 
 if __name__ == "__main__":